@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Benchmark suite for match_value: synthetic documents of growing size are encoded, fitted, diffed, pruned and
+rendered, and the timings are written as JSON, so runs can be compared and scaling curves plotted.
+
+    python benchmarks.py --sizes 10 100 1000 --output /tmp/bench.json
+"""
+import argparse
+import json
+import platform
+import sys
+import timeit
+
+import match_value
+from match_value import Arg, Constant, FitContext, Increase, JsonCodec
+
+
+class Case(object):
+    """
+    A benchmark case: builds a pair (actual json text, expectation factory) for a given size.
+    The expectation is built anew for every run, because captures accumulate values between fits
+    """
+    def __init__(self, name, actual, expected, sizes):
+        self.name = name
+        self.actual = actual
+        self.expected = expected
+        self.sizes = sizes
+
+    def __call__(self, size):
+        return json.dumps(self.actual(size)), lambda: JsonCodec.encode_expected(self.expected(size))
+
+
+def offer(idx):
+    return {'id': idx, 'title': 'offer {}'.format(idx), 'price': 1000 - idx, 'oldprice': 2000 - 2 * idx,
+            'bid': 7, 'shop': idx % 13}
+
+
+def wide_list(size):
+    return [offer(idx) for idx in xrange(size)]
+
+
+def deep_nesting(size):
+    document = {'id': size, 'leaf': True}
+    for level in xrange(size):
+        document = {'id': level, 'child': document}
+    return document
+
+
+def many_keys(size):
+    return dict(('key{}'.format(idx), idx) for idx in xrange(size))
+
+
+def badly_mismatching(size):
+    # every tenth offer of the expectation differs by price from its actual counterpart
+    return [dict(offer(idx), price=-idx) if idx % 10 == 0 else offer(idx) for idx in xrange(0, size, 3)]
+
+
+def capture_heavy(size):
+    price = Arg()
+    return {'id': Increase, 'price': price, 'oldprice': price * 2, 'bid': Constant}
+
+
+CASES = [
+    # mostly matching: every third offer is expected
+    Case('wide_list', wide_list, lambda size: wide_list(size)[::3], [10, 100, 1000]),
+    Case('deep_nesting', deep_nesting, lambda size: deep_nesting(size)['child'], [10, 100, 400]),
+    Case('many_keys', many_keys, lambda size: dict(many_keys(size).items()[::2]), [10, 100, 1000]),
+    Case('badly_mismatching', wide_list, badly_mismatching, [10, 50, 100]),
+    Case('capture_heavy', wide_list, capture_heavy, [10, 100, 1000]),
+]
+
+
+class Benchmark(object):
+    """
+    Runs every case at every size and times the pipeline stages: encode_actual, fit (fast phase on a fresh
+    document, so the tree index is built inside the measurement), diff (ChildrenDiffBuilder hypotheses),
+    prune and render of the diff. Each stage is repeated and the best and mean times are reported in seconds
+    """
+    def __init__(self, cases=CASES, sizes=None, repeat=3):
+        self.cases = cases
+        self.sizes = sizes
+        self.repeat = repeat
+
+    def run(self):
+        results = []
+        for case in self.cases:
+            for size in self.sizes or case.sizes:
+                results.extend(self.measure(case, size))
+        return {
+            'python': platform.python_version(),
+            'numpy': match_value.numpy is not None,
+            'repeat': self.repeat,
+            'results': results,
+        }
+
+    def measure(self, case, size):
+        source, expectation = case(size)
+        stages = {}
+        matched = None
+        for _ in xrange(self.repeat):
+            actual, elapsed = self._timed(JsonCodec.encode_actual, source)
+            stages.setdefault('encode_actual', []).append(elapsed)
+
+            expected = expectation()
+            fit, elapsed = self._timed(expected.fit, actual, FitContext())
+            stages.setdefault('fit', []).append(elapsed)
+            matched = bool(fit)
+            if matched:
+                continue
+
+            diff, elapsed = self._timed(expected.diff, actual)
+            stages.setdefault('diff', []).append(elapsed)
+            if diff is None:
+                # fit failed on a formula, the structure itself matches
+                continue
+            _, elapsed = self._timed(diff.prune)
+            stages.setdefault('prune', []).append(elapsed)
+            _, elapsed = self._timed(diff.render, 0)
+            stages.setdefault('render', []).append(elapsed)
+
+        return [{
+            'case': case.name,
+            'size': size,
+            'stage': stage,
+            'best': min(times),
+            'mean': sum(times) / len(times),
+            'matched': matched,
+        } for stage, times in sorted(stages.iteritems())]
+
+    @staticmethod
+    def _timed(function, *args):
+        started = timeit.default_timer()
+        result = function(*args)
+        return result, timeit.default_timer() - started
+
+    @classmethod
+    def main(cls, argv):
+        parser = argparse.ArgumentParser(description='Time match_value stages on synthetic documents')
+        parser.add_argument('--sizes', type=int, nargs='+', help='override sizes of every case')
+        parser.add_argument('--cases', nargs='+', choices=[case.name for case in CASES], help='cases to run')
+        parser.add_argument('--repeat', type=int, default=3, help='runs per stage, the best one is reported')
+        parser.add_argument('--output', help='json file for results, stdout by default')
+        args = parser.parse_args(argv)
+
+        cases = [case for case in CASES if args.cases is None or case.name in args.cases]
+        report = cls(cases, args.sizes, args.repeat).run()
+        text = json.dumps(report, indent=2, sort_keys=True)
+        if args.output:
+            with open(args.output, 'w') as output:
+                output.write(text + '\n')
+        else:
+            print text
+        return 0
+
+
+if __name__ == '__main__':
+    sys.exit(Benchmark.main(sys.argv[1:]))